@@ -29,6 +29,14 @@ class CLI_PROGRESS:
         self.settings = settings
         self.action = action
 
+        # Full length progress and remainder bars, sliced to show progress.
+        self.width = self.settings.progress.PROG_WIDTH
+        self.done_bar = "#" * self.width
+        self.todo_bar = "-" * self.width
+        # Progress line, showing progress and remaining in different colours.
+        # Note printing on same line so first action is to return to start of line.
+        self.line = f"\r{self.action} : [\033[1;32m{{done}}{{todo}}\033[0;37m] [{{prog:3d}} %][Ref: {{ref:5d}}]"
+
         # Print a new line to separate the progress bar from previous text.
         print()
 
@@ -42,22 +50,13 @@ class CLI_PROGRESS:
             ref:        The id of the reference question.
         """
 
-        # Calculate length of progress done and to do.
-        left = self.settings.progress.PROG_WIDTH * prog // 100
-        right = self.settings.progress.PROG_WIDTH - left
-
-        # Complile strings to show progress.
-        # Show progress and remainder.
-        progess = "#" * left
-        remainging = "-" * right
+        # Calculate length of progress done.
+        left = self.width * prog // 100
 
-        # Print the progress bar.
-        # Note printing on same line so first action
-        # is to return to start of line.
-        # Also, don't do new line at the end.
-        # Show progress and remaining in different colours.
+        # Print the progress bar, slicing the precomputed bars.
+        # Don't do new line at the end.
         print(
-            f"\r{self.action} : [\033[1;32m{progess}{remainging}\033[0;37m] [{prog:3d} %][Ref: {ref:5d}]",
+            self.line.format(done=self.done_bar[:left], todo=self.todo_bar[left:], prog=prog, ref=ref),
             sep="",
             end="",
             flush=True,
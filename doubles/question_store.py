@@ -3,38 +3,56 @@ Class to hold original question store (from file),
 and results of duplication detection.
 """
 
+from collections import deque
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+import functools
 import logging
 import os
-from typing import List
+from typing import Deque, Dict, Iterator, List, Tuple
 
 import dotsi  # type: ignore
+import numpy as np
 import openpyxl
 import spacy
 from spacy.lang.en.stop_words import STOP_WORDS
 from spacy.language import Language
-import spacy_universal_sentence_encoder
 
 import doubles.progress as prog
+from doubles.vector_cache import Vector_Cache
+
+try:
+    import faiss  # type: ignore
+except ImportError:
+    faiss = None  # type: ignore
 
 # Get looger for this application
 log = logging.getLogger(__name__)
 
-# Load the spaCy model.
-nlp = spacy_universal_sentence_encoder.load_model("en_use_lg")
+# The spaCy model, loaded on first use (see get_nlp()).
+MODEL = "en_use_lg"
+
+# Common words that bias matching (stop words), as a set for fast lookup.
+STOP_SET = frozenset(STOP_WORDS)
+# Translation table to remove punctuation.
+PUNCTUATION = str.maketrans("", "", "?,.!")
 
 
 class Question:
     """
     Question class.
+    Statuses and vector are views of the owning store's columns.
     """
 
-    def __init__(self, lid: int, question_text: str, answer: bool) -> None:
+    def __init__(self, lid: int, question_text: str, answer: bool, owner: "Question_Store", idx: int) -> None:
         """
         Question initialisation.
         Args:
             lid:            Legacy Id.
             question_text:  Question text (including ?).
             answer:         Expected response True=yes, False=no.
+            owner:          Question store holding the question.
+            idx:            Position of the question in the store.
         Returns:
             Returns         None.
         """
@@ -44,27 +62,67 @@ class Question:
 
         # Raw question text.
         self.original_question = question_text
-        # Normalise the string and convert to tokens.
-        self.tokens = self.original_question.lower().split()
-        # Remove punctuation.
-        self.tokens = [token.strip("?,.!") for token in self.tokens]
+        # Normalise the string, remove punctuation, and convert to tokens.
+        tokens = self.original_question.lower().translate(PUNCTUATION).split()
         # Remove common words that bias matching (stop words).
-        self.tokens = [token for token in self.tokens if token not in list(STOP_WORDS)]
+        self.tokens = [token for token in tokens if token not in STOP_SET]
         # Reform tokens to processing string.
         self.question = " ".join(self.tokens)
 
         # Expected answer, True=yes, False=no.
         self.answer = answer
 
-        # Whether or not question has been the reference question yet.
-        self.reference = False
-        # Question statuses.
-        self.unique = True
-        self.duplicate = False
-        # List of duplicates to this question.
-        self.duplicates: List[Question] = []
-        # The question this is a duplicate of (only the first).
-        self.duplicate_of = 0
+        # Where the question's columns are held.
+        self.owner = owner
+        self.idx = idx
+
+    @property
+    def reference(self) -> bool:
+        """
+        Whether or not question has been the reference question yet.
+        """
+
+        return bool(self.owner.reference[self.idx])
+
+    @property
+    def unique(self) -> bool:
+        """
+        Whether or not question is unique.
+        """
+
+        return bool(self.owner.unique[self.idx])
+
+    @property
+    def duplicate(self) -> bool:
+        """
+        Whether or not question is a duplicate.
+        """
+
+        return bool(self.owner.duplicate[self.idx])
+
+    @property
+    def duplicates(self) -> List["Question"]:
+        """
+        List of duplicates to this question.
+        """
+
+        return [self.owner.store[idx] for idx in self.owner.duplicates[self.idx]]
+
+    @property
+    def duplicate_of(self) -> int:
+        """
+        The question this is a duplicate of (only the first), 0 if none.
+        """
+
+        return int(self.owner.duplicate_of[self.idx])
+
+    @property
+    def vec(self) -> np.ndarray:
+        """
+        Normalised sentence embedding of the question.
+        """
+
+        return self.owner.vecs[self.idx]
 
 
 class Question_Store:
@@ -92,22 +150,82 @@ class Question_Store:
         self.num_q = 0
         self.status = self.settings.status.ST_NOQ
 
-        # Load the workbook
-        workbook = openpyxl.load_workbook(filename=ifile)
+        # Load the workbook, streaming rather than loading it all into memory.
+        workbook = openpyxl.load_workbook(filename=ifile, read_only=True, data_only=True)
 
         # Select the active sheet
         sheet = workbook.active
 
-        # Iterate through rows in the worksheet and extract question details.
-        for row_num in range(2, sheet.max_row + 1):
-            q_text = sheet.cell(row=row_num, column=1).value
-            q_answer = bool(sheet.cell(row=row_num, column=2).value)
-
-            self.store.append(Question(row_num - 1, q_text, q_answer))
+        # Iterate once through rows in the worksheet and extract question details.
+        for lid, (q_text, q_answer) in enumerate(sheet.iter_rows(min_row=2, max_col=2, values_only=True), start=1):
+            self.store.append(Question(lid, q_text, bool(q_answer), self, self.num_q))
             self.num_q += 1
 
+        # Read only workbooks keep the file open until closed.
+        workbook.close()
+
         log.info(f"Number of questions read from file: {self.num_q}")
 
+        # Per question columns, in the same order as the store.
+        self.lids = np.array([q.lid for q in self.store], dtype=np.int64)
+        self.answers = np.array([q.answer for q in self.store], dtype=np.bool_)
+        # Question statuses.
+        self.reference = np.zeros(self.num_q, dtype=np.bool_)
+        self.unique = np.ones(self.num_q, dtype=np.bool_)
+        self.duplicate = np.zeros(self.num_q, dtype=np.bool_)
+        # Id of the question each question is a duplicate of (only the first).
+        self.duplicate_of = np.zeros(self.num_q, dtype=np.int64)
+        # Indices of the duplicates of each question.
+        self.duplicates: List[List[int]] = [[] for _ in range(self.num_q)]
+        # Normalised sentence embeddings, one row per question (set when encoded).
+        self.vecs = np.zeros((self.num_q, 0), dtype=np.float32)
+
+        # Encode the questions once, ready for comparison.
+        self.encode()
+
+    def encode(self) -> None:
+        """
+        Encode questions into sentence embeddings.
+        Questions not in the vector cache are passed through the language model in batches,
+        and the normalised vectors kept as rows of a single matrix.
+        Returns:
+            Returns None.
+        """
+
+        log.info("Encoding questions...")
+
+        if self.num_q == 0:
+            return
+
+        texts = [q.question for q in self.store]
+
+        # Reuse vectors encoded on previous runs.
+        cache = None
+        found: Dict[int, np.ndarray] = {}
+        if self.settings.cache.ENABLED is True:
+            cache = Vector_Cache(self.settings.cache.DIR, MODEL)
+            found = cache.lookup(texts)
+        missing = [idx for idx in range(self.num_q) if idx not in found]
+        log.info(f"Questions to encode: {len(missing)}, from cache: {len(found)}")
+
+        # Encode the rest.
+        if missing:
+            docs = get_nlp().pipe(
+                (texts[idx] for idx in missing),
+                batch_size=self.settings.encoder.BATCH_SIZE,
+                n_process=self.settings.encoder.N_PROCESS,
+            )
+            encoded = np.stack([np.asarray(doc.vector) for doc in docs]).astype(np.float32)
+            if cache is not None:
+                cache.save([texts[idx] for idx in missing], encoded)
+            found.update(zip(missing, encoded))
+
+        vecs = np.stack([found[idx] for idx in range(self.num_q)]).astype(np.float32)
+
+        # Normalise once here so similarity is a plain dot product,
+        # guarding against a zero vector.
+        self.vecs = vecs / (np.linalg.norm(vecs, axis=1, keepdims=True) + 1e-12)
+
     def process(self, progress) -> None:
         """
         Process questions.
@@ -124,8 +242,8 @@ class Question_Store:
         # Number of duplicate questions detected, and duplicates with errors.
         self.num_duplicates = 0
 
-        # If only one question, nothing to test as questions unique.
-        if self.num_q == 1:
+        # If no more than one question, nothing to test as questions unique.
+        if self.num_q <= 1:
             self.status = self.settings.status.ST_NOQ
             log.warning(f"Status: {self.status}")
             return
@@ -135,48 +253,132 @@ class Question_Store:
             pb = prog.CLI_PROGRESS(self.settings, "Analysing")
 
         # Else, process questions.
-        # Progress increment for reference question (percent).
-        pps = 100 / self.num_q
-
-        for idx, q in enumerate(self.store[0:]):
+        # Last progress shown (percent), so the bar is only redrawn when it changes.
+        shown = -1
+
+        # Source of matching questions for each question, in question order.
+        if self.settings.ann.ENABLED is True and faiss is None:
+            log.warning("Approximate neighbour search requested but faiss not installed.")
+        if self.settings.ann.ENABLED is True and faiss is not None:
+            matcher = self.ann_matches()
+        else:
+            matcher = self.block_matches()
+
+        # Local names for the store and its columns, used on every iteration.
+        store = self.store
+        lids = self.lids
+        reference = self.reference
+        unique = self.unique
+        duplicate = self.duplicate
+        duplicate_of = self.duplicate_of
+        duplicates = self.duplicates
+        # Only walk matches for logging when debug logging is on.
+        debug = log.isEnabledFor(logging.DEBUG)
+
+        for idx, matches, scores in matcher:
             if progress is True:
-                pb.show_progress(int((idx + 1) * pps), q.lid)
+                pct = (idx + 1) * 100 // self.num_q
+                if pct != shown:
+                    pb.show_progress(pct, lids[idx])
+                    shown = pct
 
             # Need to find the first reference question.
             # That is question that hasn't been compared against yet,
             # or is not already a duplicate question.
-            if q.reference is True or q.duplicate is True:
+            if reference[idx] or duplicate[idx]:
                 continue
-            else:
-                # Mark this question as being a reference question.
-                q.reference = True
-                log.debug(f"Ref: {q.lid}, Text: {q.original_question}")
-
-                # Need to find next question that isn't a duplicate.
-                for idx2, q2 in enumerate(self.store[idx + 1 :]):
-                    if q2.duplicate is True:
-                        if progress is True:
-                            pb.show_progress(int((idx + 1) * pps), q.lid)
-                        continue
-                    else:
-                        # Have 2 questions to compare now.
-                        # Check similarity.
-                        similarity = get_similarity(q.question, q2.question)
-                        if similarity > self.settings.scores.SS_MATCH:
-                            # Similarity score close enough for a match.
-                            q2.unique = False
-                            q2.duplicate = True
-                            q.duplicates.append(q2)
-                            self.num_duplicates += 1
-                            q2.duplicate_of = q.lid
-                            log.debug(
-                                f"DUPLICATE: {q2.lid}, {q2.original_question}, sim: {similarity :.3f}"
-                            )
-                        else:
-                            # Not a match.
-                            log.debug(
-                                f"Chk: {q2.lid}, {q2.original_question}, sim: {similarity :.3f}"
-                            )
+
+            # Mark this question as being a reference question.
+            reference[idx] = True
+            q = store[idx]
+            if debug:
+                log.debug("Ref: %s, Text: %s", q.lid, q.original_question)
+
+            # Later questions with similarity score close enough for a match,
+            # that are not already a duplicate of an earlier reference.
+            live = ~duplicate[matches]
+            matches, scores = matches[live], scores[live]
+
+            # Mark them as duplicates of this question.
+            unique[matches] = False
+            duplicate[matches] = True
+            duplicate_of[matches] = q.lid
+            duplicates[idx].extend(matches.tolist())
+            self.num_duplicates += len(matches)
+            if debug:
+                for idx2, similarity in zip(matches, scores):
+                    q2 = store[idx2]
+                    log.debug("DUPLICATE: %s, %s, sim: %.3f", q2.lid, q2.original_question, similarity)
+
+    def block_matches(self) -> Iterator[Tuple[int, np.ndarray, np.ndarray]]:
+        """
+        Find matching questions by exhaustive comparison.
+        A block of rows is scored at a time against the questions that follow,
+        so the full N x N similarity matrix is never held in memory.
+        Returns:
+            Yields question index, indices of later matching questions, and their similarity.
+        """
+
+        vecs = self.vecs
+        block = self.settings.analysis.BLOCK_SIZE
+        starts = range(0, self.num_q, block)
+        workers = min(self.settings.analysis.WORKERS or os.cpu_count() or 1, len(starts))
+
+        # Blocks are independent, and NumPy releases the GIL, so score them in parallel.
+        # Results are taken in question order to preserve the first reference wins ordering.
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pending: Deque[Tuple[int, Future]] = deque()
+            for start in starts:
+                pending.append((start, pool.submit(score_block, vecs, start, block, self.settings.scores.SS_MATCH)))
+                # Keep at most one block in flight per worker, to bound memory.
+                if len(pending) < workers:
+                    continue
+                first, future = pending.popleft()
+                for row, (matches, scores) in enumerate(future.result()):
+                    yield first + row, matches, scores
+
+            # Then the blocks still in flight.
+            for first, future in pending:
+                for row, (matches, scores) in enumerate(future.result()):
+                    yield first + row, matches, scores
+
+    def ann_matches(self) -> Iterator[Tuple[int, np.ndarray, np.ndarray]]:
+        """
+        Find matching questions using an approximate nearest neighbour index.
+        Only the nearest neighbours of each reference question are considered,
+        and their similarity is confirmed exactly against the match threshold.
+        Returns:
+            Yields question index, indices of later matching questions, and their similarity.
+        """
+
+        vecs = self.vecs
+
+        # Build the neighbour index, inner product being cosine similarity for normalised vectors.
+        index = faiss.IndexHNSWFlat(vecs.shape[1], self.settings.ann.HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        index.add(vecs)
+        k = min(self.settings.ann.NEIGHBOURS, self.num_q)
+
+        # Search for all questions in one call, so faiss can spread the queries over its threads.
+        _, neighbours = index.search(vecs, k)
+
+        # Pairs of each question with its neighbours after it (missing neighbours are -1).
+        rows = np.repeat(np.arange(self.num_q), k)
+        cols = neighbours.ravel()
+        later = cols > rows
+        rows, cols = rows[later], cols[later]
+
+        # Confirm with exact similarity.
+        scores = score_pairs(vecs, rows, cols)
+        keep = scores > self.settings.scores.SS_MATCH
+        rows, cols, scores = rows[keep], cols[keep], scores[keep]
+
+        # Group by question, neighbours in question order.
+        order = np.lexsort((cols, rows))
+        rows, cols, scores = rows[order], cols[order], scores[order]
+        splits = np.searchsorted(rows, np.arange(1, self.num_q))
+
+        for idx, (matches, match_scores) in enumerate(zip(np.split(cols, splits), np.split(scores, splits))):
+            yield idx, matches, match_scores
 
     def results(self) -> None:
         """
@@ -208,51 +410,53 @@ class Question_Store:
         log.info("Export results to file...")
 
         # Generate the output file with duplicates removed.
-        work_book = openpyxl.Workbook()
-        sheet1 = work_book.active
-        sheet1.title = "Unique_Questions"
+        # Write only workbooks stream rows out rather than building every cell in memory.
+        work_book = openpyxl.Workbook(write_only=True)
+        sheet1 = work_book.create_sheet(title="Unique_Questions")
 
         # Write title row.
-        sheet1["A1"].value = "Id"
-        sheet1["B1"].value = "Question"
-        sheet1["C1"].value = "Answer"
-
-        # Export questions with duplicates removed.
-        ex_row = 2
-        for idx, q in enumerate(self.store[0:]):
-            if q.duplicate is False:
-                sheet1.cell(row=ex_row, column=1).value = q.lid
-                sheet1.cell(row=ex_row, column=2).value = q.original_question
-                sheet1.cell(row=ex_row, column=3).value = "Yes" if q.answer == 1 else "No"
-                ex_row += 1
+        sheet1.append(("Id", "Question", "Answer"))
 
         # Export duplicates to a separate sheet.
-        work_book.create_sheet(title="Duplicates")
-        sheet2 = work_book["Duplicates"]
+        sheet2 = work_book.create_sheet(title="Duplicates")
 
         # Write title row.
-        sheet2["A1"].value = "Id"
-        sheet2["B1"].value = "Question"
-        sheet2["C1"].value = "Answer"
-        sheet2["D1"].value = "Duplicate of"
-
-        # Export duplicate questions.
-        ex_row = 2
-        for idx, q in enumerate(self.store[0:]):
-            if q.duplicate is True:
-                sheet2.cell(row=ex_row, column=1).value = q.lid
-                sheet2.cell(row=ex_row, column=2).value = q.original_question
-                sheet2.cell(row=ex_row, column=3).value = "Yes" if q.answer == 1 else "No"
-                sheet2.cell(row=ex_row, column=4).value = q.duplicate_of
-                ex_row += 1
+        sheet2.append(("Id", "Question", "Answer", "Duplicate of"))
+
+        # Export questions in a single pass,
+        # unique questions to the first sheet and duplicates to the second.
+        for q, lid, answer, duplicate, duplicate_of in zip(
+            self.store, self.lids.tolist(), self.answers.tolist(), self.duplicate.tolist(), self.duplicate_of.tolist()
+        ):
+            if duplicate:
+                sheet2.append((lid, q.original_question, "Yes" if answer else "No", duplicate_of))
+            else:
+                sheet1.append((lid, q.original_question, "Yes" if answer else "No"))
 
         # Save the workbook.
         work_book.save(ofile)
 
 
-def get_similarity(q1: str, q2: str) -> float:
+@functools.lru_cache(maxsize=1)
+def get_nlp() -> Language:
+    """
+    Function to load the spaCy model, once, when first needed.
+    Loading is slow and memory hungry, so is only done if questions need encoding.
+        Returns:
+            Language:   The spaCy model.
+    """
+
+    # Imported here as importing it loads TensorFlow.
+    import spacy_universal_sentence_encoder  # pylint: disable=import-outside-toplevel
+
+    log.info(f"Loading language model: {MODEL}")
+    return spacy_universal_sentence_encoder.load_model(MODEL)
+
+
+def get_similarity(q1: Question, q2: Question) -> float:
     """
-    Function to use natural language processor to compare 2 questions for similarity.
+    Function to compare 2 encoded questions for similarity.
+    Questions must already be encoded, see Question_Store.encode().
         Args:
             q1:         Reference question.
             q2:         Question to compare against reference.
@@ -260,9 +464,48 @@ def get_similarity(q1: str, q2: str) -> float:
             float:      Similarity between questions, 0 to 1.
     """
 
-    # Process the input questions.
-    proc_q1 = nlp(q1)
-    proc_q2 = nlp(q2)
+    # Cosine similarity of the normalised vectors.
+    return float(np.dot(q1.vec, q2.vec))
+
+
+def score_block(vecs: np.ndarray, start: int, block: int, threshold: float) -> List[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Function to find matches for a block of reference questions.
+        Args:
+            vecs:       Question vectors for all questions, one per row.
+            start:      Index of the first reference question in the block.
+            block:      Number of reference questions in the block.
+            threshold:  Similarity score above which questions match.
+        Returns:
+            List:       For each reference, indices of later matching questions and their similarity.
+    """
+
+    # Score the block against itself and all later questions.
+    sims = vecs[start : start + block] @ vecs[start:].T
+
+    # Matches with later questions only, i.e. above the diagonal.
+    rows, cols = np.nonzero(np.triu(sims > threshold, k=1))
+    splits = np.searchsorted(rows, np.arange(1, sims.shape[0]))
+
+    return list(zip(np.split(cols + start, splits), np.split(sims[rows, cols], splits)))
+
+
+def score_pairs(vecs: np.ndarray, rows: np.ndarray, cols: np.ndarray, chunk: int = 65536) -> np.ndarray:
+    """
+    Function to score pairs of questions for similarity.
+        Args:
+            vecs:       Normalised question vectors, one per row.
+            rows:       Index of the first question of each pair.
+            cols:       Index of the second question of each pair.
+            chunk:      Number of pairs scored at a time, to limit memory for gathered vectors.
+        Returns:
+            ndarray:    Similarity of each pair.
+    """
+
+    scores = np.empty(len(rows), dtype=np.float32)
+    for start in range(0, len(rows), chunk):
+        end = start + chunk
+        # Row by row dot products of the gathered vectors.
+        scores[start:end] = np.einsum("ij,ij->i", vecs[rows[start:end]], vecs[cols[start:end]])
 
-    # Determine the similarity score.
-    return proc_q1.similarity(proc_q2)
+    return scores
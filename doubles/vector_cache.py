@@ -0,0 +1,131 @@
+"""
+Disk cache of question sentence embeddings.
+"""
+
+import hashlib
+import json
+import logging
+import os
+from typing import Dict, List
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+
+class Vector_Cache:
+    """
+    Cache of question vectors, so questions are only encoded once across runs.
+    Each save adds a .npy file of the new vectors (memory mapped when read),
+    with a JSON index from hash of model and text to file and row number.
+    Existing vector files are never rewritten.
+    """
+
+    def __init__(self, cache_dir: str, model: str) -> None:
+        """
+        Vector cache initialisation.
+        Args:
+            cache_dir:  Directory holding the cache files.
+            model:      Name of the model the vectors are from.
+        Returns:
+            Returns None.
+        """
+
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.model = model
+        self.index_file = os.path.join(self.cache_dir, "index.json")
+
+        # Load any existing cache.
+        self.index: Dict[str, List[int]] = {}
+        self.vecs: List[np.ndarray] = []
+        if os.path.exists(self.index_file):
+            try:
+                with open(self.index_file, "r") as f:
+                    self.index = json.load(f)
+                num_files = max((file_num for file_num, _ in self.index.values()), default=-1) + 1
+                self.vecs = [np.load(self.vec_file(file_num), mmap_mode="r") for file_num in range(num_files)]
+            except (OSError, ValueError, TypeError) as e:
+                # A damaged cache is treated as empty, so questions are encoded again.
+                log.warning(f"Ignoring unreadable vector cache: {e}")
+                self.index = {}
+                self.vecs = []
+
+        log.info(f"Vectors in cache: {len(self.index)}")
+
+    def vec_file(self, file_num: int) -> str:
+        """
+        Path of a vector file.
+        Args:
+            file_num:   Number of the vector file.
+        Returns:
+            Returns path of the file.
+        """
+
+        return os.path.join(self.cache_dir, f"vectors-{file_num}.npy")
+
+    def key(self, text: str) -> str:
+        """
+        Cache key for a question.
+        Args:
+            text:       Question text as encoded.
+        Returns:
+            Returns hash of model name and text.
+        """
+
+        return hashlib.sha1(f"{self.model}\n{text}".encode("utf-8")).hexdigest()
+
+    def lookup(self, texts: List[str]) -> Dict[int, np.ndarray]:
+        """
+        Look up cached vectors for questions.
+        Args:
+            texts:      Question texts as encoded.
+        Returns:
+            Returns dictionary of position in texts to vector, for those in the cache.
+        """
+
+        found = {}
+        for pos, text in enumerate(texts):
+            entry = self.index.get(self.key(text))
+            if entry is not None:
+                file_num, row = entry
+                found[pos] = np.array(self.vecs[file_num][row])
+
+        return found
+
+    def save(self, texts: List[str], vecs: np.ndarray) -> None:
+        """
+        Add newly encoded vectors to the cache and write it out.
+        Args:
+            texts:      Question texts as encoded.
+            vecs:       Vectors for the texts, one per row.
+        Returns:
+            Returns None.
+        """
+
+        # Only add texts not already cached.
+        new = {}
+        for pos, text in enumerate(texts):
+            key = self.key(text)
+            if key not in self.index and key not in new:
+                new[key] = pos
+        if not new:
+            return
+
+        # New vectors go in a file of their own, so files already memory mapped are left alone.
+        file_num = len(self.vecs)
+        vec_file = self.vec_file(file_num)
+        for row, key in enumerate(new):
+            self.index[key] = [file_num, row]
+
+        # Write to temporary files and swap in, so an interrupted write can't corrupt the cache.
+        # The index is swapped in last, so it only refers to complete vector files.
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(vec_file + ".tmp", "wb") as f:
+            np.save(f, vecs[list(new.values())].astype(np.float32))
+        os.replace(vec_file + ".tmp", vec_file)
+        with open(self.index_file + ".tmp", "w") as f:
+            json.dump(self.index, f)
+        os.replace(self.index_file + ".tmp", self.index_file)
+
+        self.vecs.append(np.load(vec_file, mmap_mode="r"))
+        log.info(f"Vectors added to cache: {len(new)}")
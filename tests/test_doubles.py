@@ -1,8 +1,15 @@
+import types
+import zlib
+
 import dotsi
+import numpy as np
 import openpyxl
+import pytest
 
+import doubles.question_store
 from doubles.app_settings import load
 from doubles.question_store import Question_Store
+from doubles.vector_cache import Vector_Cache
 
 def test_doubles():
     """
@@ -42,3 +49,181 @@ def test_doubles():
     assert(questions.store[1].duplicate == True)
     assert(questions.store[1].duplicate_of == 1)
     assert(questions.store[2].unique == True)
+
+
+def test_vector_cache(tmp_path):
+    """
+    Case with vectors saved to the cache and found again.
+    """
+
+    vecs = np.arange(8, dtype=np.float32).reshape(2, 4)
+
+    cache = Vector_Cache(str(tmp_path), "model")
+    assert(cache.lookup(["one", "two"]) == {})
+    cache.save(["one", "two"], vecs)
+
+    # A new cache reads back what was saved, and other models don't match.
+    found = Vector_Cache(str(tmp_path), "model").lookup(["two", "three", "one"])
+    assert(sorted(found) == [0, 2])
+    assert(np.array_equal(found[0], vecs[1]))
+    assert(np.array_equal(found[2], vecs[0]))
+    assert(Vector_Cache(str(tmp_path), "other").lookup(["one"]) == {})
+
+    # Later saves add to the cache, skipping vectors already there.
+    cache.save(["two", "three"], vecs + 10)
+    found = Vector_Cache(str(tmp_path), "model").lookup(["one", "two", "three"])
+    assert(np.array_equal(found[1], vecs[1]))
+    assert(np.array_equal(found[2], vecs[1] + 10))
+
+    # A cache with a vector file missing is treated as empty.
+    (tmp_path / "vectors-1.npy").unlink()
+    assert(Vector_Cache(str(tmp_path), "model").lookup(["one", "three"]) == {})
+
+
+def test_empty_store(tmp_path):
+    """
+    Case with no questions in the input file.
+    """
+
+    # Input file with only the title row.
+    work_book = openpyxl.Workbook()
+    work_book.active.append(("Question", "Answer"))
+    work_book.save(tmp_path / "empty.xlsx")
+
+    settings = dotsi.Dict(load("./doubles/settings.yaml"))
+    questions = Question_Store(str(tmp_path / "empty.xlsx"), settings)
+    questions.process(None)
+
+    assert(questions.num_q == 0)
+    assert(questions.num_duplicates == 0)
+
+
+class Fake_NLP:
+    """
+    Stand in for the language model, so tests don't need to download it.
+    Each word gets a fixed random vector, and a question is the sum of its words.
+    """
+
+    def pipe(self, texts, batch_size, n_process):
+        for text in texts:
+            vector = np.zeros(512, dtype=np.float32)
+            for word in text.split():
+                vector += np.random.default_rng(zlib.crc32(word.encode())).standard_normal(512)
+            yield types.SimpleNamespace(vector=vector)
+
+
+def fake_store(tmp_path, monkeypatch, questions, settings):
+    """
+    Question store from a list of questions, encoded with the stand in model.
+    """
+
+    monkeypatch.setattr(doubles.question_store, "get_nlp", Fake_NLP)
+
+    work_book = openpyxl.Workbook()
+    work_book.active.append(("Question", "Answer"))
+    for question in questions:
+        work_book.active.append((question, "yes"))
+    work_book.save(tmp_path / "input.xlsx")
+
+    store = Question_Store(str(tmp_path / "input.xlsx"), settings)
+    store.process(None)
+    return store
+
+
+# Questions with some rewordings, some repeated.
+QUESTIONS = [
+    "Is the red kettle boiling water quickly?",
+    "Is the garden fence painted green?",
+    "Is the red kettle heating water quickly?",
+    "Does the train leave from platform nine?",
+    "Is the garden fence painted green?",
+    "Is the red kettle boiling water slowly?",
+    "Does the bus leave from platform nine?",
+    "Are the library books overdue today?",
+]
+
+
+def fake_settings():
+    """
+    Settings for tests using the stand in model.
+    """
+
+    settings = dotsi.Dict(load("./doubles/settings.yaml"))
+    settings.cache.ENABLED = False
+    return settings
+
+
+def test_blocks_in_parallel(tmp_path, monkeypatch):
+    """
+    Case with questions scored a block at a time, in parallel, matching a single block.
+    """
+
+    settings = fake_settings()
+    single = fake_store(tmp_path, monkeypatch, QUESTIONS, settings)
+
+    settings.analysis.BLOCK_SIZE = 1
+    settings.analysis.WORKERS = 3
+    blocks = fake_store(tmp_path, monkeypatch, QUESTIONS, settings)
+
+    assert(single.num_duplicates > 0)
+    assert(blocks.num_duplicates == single.num_duplicates)
+    assert(np.array_equal(blocks.duplicate, single.duplicate))
+    assert(np.array_equal(blocks.duplicate_of, single.duplicate_of))
+
+
+def test_ann_matches(tmp_path, monkeypatch):
+    """
+    Case with questions matched by approximate nearest neighbours, matching exhaustive comparison.
+    """
+
+    pytest.importorskip("faiss")
+
+    settings = fake_settings()
+    exhaustive = fake_store(tmp_path, monkeypatch, QUESTIONS, settings)
+
+    settings.ann.ENABLED = True
+    ann = fake_store(tmp_path, monkeypatch, QUESTIONS, settings)
+
+    assert(exhaustive.num_duplicates > 0)
+    assert(ann.num_duplicates == exhaustive.num_duplicates)
+    assert(np.array_equal(ann.duplicate, exhaustive.duplicate))
+    assert(np.array_equal(ann.duplicate_of, exhaustive.duplicate_of))
+
+
+def test_export(tmp_path, monkeypatch):
+    """
+    Case with unique questions and duplicates exported to separate sheets.
+    """
+
+    questions = fake_store(tmp_path, monkeypatch, QUESTIONS, fake_settings())
+    questions.export(tmp_path / "out.xlsx")
+
+    work_book = openpyxl.load_workbook(tmp_path / "out.xlsx")
+    assert(work_book.sheetnames == ["Unique_Questions", "Duplicates"])
+
+    unique = list(work_book["Unique_Questions"].values)
+    assert(unique[0] == ("Id", "Question", "Answer"))
+    assert([row[0] for row in unique[1:]] == [1, 2, 4, 7, 8])
+    assert(unique[1] == (1, QUESTIONS[0], "Yes"))
+
+    # Rewordings of the first question, and a repeat of the second.
+    duplicates = list(work_book["Duplicates"].values)
+    assert(duplicates[0] == ("Id", "Question", "Answer", "Duplicate of"))
+    assert(duplicates[1:] == [(3, QUESTIONS[2], "Yes", 1), (5, QUESTIONS[4], "Yes", 2), (6, QUESTIONS[5], "Yes", 1)])
+
+
+def test_encode_from_cache(tmp_path, monkeypatch):
+    """
+    Case with question vectors taken from the cache rather than the language model.
+    """
+
+    settings = fake_settings()
+    settings.cache.ENABLED = True
+    settings.cache.DIR = str(tmp_path / "cache")
+    encoded = fake_store(tmp_path, monkeypatch, QUESTIONS, settings)
+
+    # A second run has every question cached, so must not load the model.
+    monkeypatch.setattr(doubles.question_store, "get_nlp", lambda: pytest.fail("Language model loaded"))
+    cached = Question_Store(str(tmp_path / "input.xlsx"), settings)
+
+    assert(np.array_equal(cached.vecs, encoded.vecs))